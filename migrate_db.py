@@ -0,0 +1,9 @@
+from tuneful.database import engine
+from tuneful.migrations import upgrade
+
+def migrate():
+    upgrade(engine, log=print)
+    print('Database is up to date')
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,24 @@
+import argparse
+import sys
+from tuneful import app
+from tuneful.storage import storage, LocalStorage
+
+def migrate():
+    parser = argparse.ArgumentParser(
+        description='Move uploads from the flat layout into sharded folders')
+    parser.add_argument('--batch-size', type=int, default=100,
+        help='number of files to move before pausing')
+    parser.add_argument('--delay', type=float, default=0.5,
+        help='seconds to pause between batches')
+    args = parser.parse_args()
+
+    if not isinstance(storage, LocalStorage):
+        sys.exit('Only uploads stored on the local disk can be migrated; '
+            'STORAGE_BACKEND is set to {}'.format(
+                app.config.get('STORAGE_BACKEND')))
+
+    moved = storage.migrate(args.batch_size, args.delay, log=print)
+    print('Migrated {} files'.format(moved))
+
+if __name__ == '__main__':
+    migrate()
@@ -2,9 +2,20 @@ import unittest
 import os
 import shutil
 import json
+import tempfile
+import datetime
+import time
+import wave
 try: from urllib.parse import urlparse
 except ImportError: from urlparse import urlparse # Py2 compatibility
 from io import StringIO, BytesIO
+from unittest import mock
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
 
 import sys; print(list(sys.modules.keys()))
 # Configure our app to use the testing databse
@@ -12,7 +23,10 @@ os.environ["CONFIG_PATH"] = "tuneful.config.TestingConfig"
 
 from tuneful import app
 from tuneful import models
-from tuneful.utils import upload_path
+from tuneful import limits
+from tuneful import previews
+from tuneful.utils import upload_path, preview_path
+from tuneful.storage import storage, LocalStorage, S3Storage
 from tuneful.database import Base, engine, session
 
 class TestAPI(unittest.TestCase):
@@ -34,8 +48,9 @@ class TestAPI(unittest.TestCase):
         # Remove the tables and their data from the database
         Base.metadata.drop_all(engine)
 
-        # Delete test upload folder
+        # Delete test upload and preview folders
         shutil.rmtree(upload_path())
+        shutil.rmtree(preview_path(), ignore_errors = True)
         
     def test_get_with_unsupported_accept_header(self):
         response = self.client.get('/api/songs',
@@ -89,6 +104,101 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(songB['file']['id'], 2)
         self.assertEqual(songB['file']['name'], 'Test Song B.mp3')
     
+    def add_songs(self):
+        fileA = models.File(filename = 'Test Song A.mp3')
+        fileB = models.File(filename = 'Test Song B.mp3')
+        songA = models.Song(file = fileA)
+        songB = models.Song(file = fileB)
+        session.add_all([fileA, fileB, songA, songB])
+        session.commit()
+
+    def get_songs(self, query):
+        response = self.client.get('/api/songs?' + query,
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(response.mimetype, 'application/json')
+        return response, json.loads(response.data.decode('ascii'))
+
+    def test_get_songs_with_fields(self):
+        self.add_songs()
+
+        response, data = self.get_songs('fields=id,file.name')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data, [
+            {'id': 1, 'file': {'name': 'Test Song A.mp3'}},
+            {'id': 2, 'file': {'name': 'Test Song B.mp3'}}
+        ])
+
+    def test_get_songs_with_only_song_fields(self):
+        self.add_songs()
+
+        response, data = self.get_songs('fields=id')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data, [{'id': 1}, {'id': 2}])
+
+    def test_get_songs_with_unknown_field(self):
+        response, data = self.get_songs('fields=id,title')
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['message'], 'Unknown field title')
+
+    def test_get_songs_with_empty_fields(self):
+        response, data = self.get_songs('fields=')
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['message'], 'No fields were requested')
+
+    def test_get_songs_skips_empty_field_names(self):
+        self.add_songs()
+
+        response, data = self.get_songs('fields=id,,')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data, [{'id': 1}, {'id': 2}])
+
+    def test_get_songs_with_unknown_format(self):
+        response, data = self.get_songs('format=bogus')
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['message'],
+            'Unknown format bogus, must be one of objects, columnar')
+
+    def test_get_songs_embedding_file_id(self):
+        self.add_songs()
+
+        response, data = self.get_songs('embed=id')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data, [{'id': 1, 'file': 1}, {'id': 2, 'file': 2}])
+
+    def test_get_songs_with_unknown_embed(self):
+        response, data = self.get_songs('embed=song')
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['message'],
+            'Unknown embed song, must be one of file, id')
+
+    def test_get_songs_columnar(self):
+        self.add_songs()
+
+        response, data = self.get_songs('format=columnar&fields=id,file.name')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data, {
+            'id': [1, 2],
+            'file.name': ['Test Song A.mp3', 'Test Song B.mp3']
+        })
+
+    def test_get_songs_columnar_embedding_file_id(self):
+        self.add_songs()
+
+        response, data = self.get_songs('format=columnar&embed=id')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data, {'id': [1, 2], 'file': [1, 2]})
+
     def test_get_song(self):
         ''' get a single song from the API and make sure it is
         the one that we requested and not a different one 
@@ -498,8 +608,614 @@ class TestAPI(unittest.TestCase):
         data = json.loads(response.data.decode('ascii'))
         self.assertEqual(urlparse(data['path']).path, '/uploads/test.txt')
 
-        path = upload_path('test.txt')
+        path = storage.path('test.txt')
         self.assertTrue(os.path.isfile(path))
+        self.assertFalse(os.path.isfile(upload_path('test.txt')))
         with open(path, 'rb') as f:
             contents = f.read()
-        self.assertEqual(contents, b'File contents')
\ No newline at end of file
+        self.assertEqual(contents, b'File contents')
+
+    def test_file_upload_with_existing_name(self):
+        ''' uploading a second file with the same name must not
+        overwrite the first '''
+        for contents in [b'First', b'Second']:
+            response = self.client.post('/api/files',
+                data = {'file': (BytesIO(contents), 'test.txt')},
+                content_type = 'multipart/form-data',
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertEqual(response.status_code, 201)
+
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['name'], 'test-1.txt')
+        self.assertEqual(urlparse(data['path']).path, '/uploads/test-1.txt')
+
+        with open(storage.path('test.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'First')
+        with open(storage.path('test-1.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'Second')
+
+    def test_file_upload_with_invalid_name(self):
+        response = self.client.post('/api/files',
+            data = {'file': (BytesIO(b'File contents'), '../')},
+            content_type = 'multipart/form-data',
+            headers = [('Accept', 'application/json')]
+        )
+
+        self.assertEqual(response.status_code, 422)
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['message'], 'Invalid file name')
+        self.assertEqual(session.query(models.File).count(), 0)
+
+    def test_get_sharded_uploaded_file(self):
+        path = storage.path('test.txt')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(b'File contents')
+
+        response = self.client.get('/uploads/test.txt')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'File contents')
+
+    def test_get_missing_uploaded_file(self):
+        response = self.client.get('/uploads/missing.txt')
+        self.assertEqual(response.status_code, 404)
+
+    def test_migrate_without_upload_folder(self):
+        missing = LocalStorage(upload_path('missing'))
+
+        self.assertEqual(list(missing.legacy_files()), [])
+        self.assertEqual(missing.migrate(delay = 0), 0)
+
+    def test_migrate_uploads(self):
+        ''' files in the flat layout are moved into their shards '''
+        for name in ['a.txt', 'b.txt', 'c.txt']:
+            with open(upload_path(name), 'wb') as f:
+                f.write(name.encode('ascii'))
+
+        moved = storage.migrate(batch_size = 2, delay = 0)
+
+        self.assertEqual(moved, 3)
+        self.assertEqual(list(storage.legacy_files()), [])
+        for name in ['a.txt', 'b.txt', 'c.txt']:
+            self.assertFalse(os.path.isfile(upload_path(name)))
+            with open(storage.path(name), 'rb') as f:
+                self.assertEqual(f.read(), name.encode('ascii'))
+
+    def test_direct_upload_with_local_storage(self):
+        response = self.client.post('/api/files/uploads',
+            data = json.dumps({'name': 'test.txt'}),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json')]
+        )
+
+        self.assertEqual(response.status_code, 501)
+        self.assertEqual(response.mimetype, 'application/json')
+
+    def test_finalize_upload_with_local_storage(self):
+        ''' finalizing must not record files outside the upload folder '''
+        for name in ['../config.py', '/etc/passwd']:
+            response = self.client.post('/api/files/uploads/finalize',
+                data = json.dumps({'name': name}),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+
+            self.assertEqual(response.status_code, 501)
+        self.assertEqual(session.query(models.File).count(), 0)
+
+    def test_rate_limit(self):
+        ''' a client which empties its token bucket gets a 429 '''
+        with mock.patch.dict(app.config, {'RATE_LIMITS': {'list': (0.1, 2)}}):
+            limits.reset()
+            for i in range(2):
+                response = self.client.get('/api/songs',
+                    headers = [('Accept', 'application/json')]
+                )
+                self.assertEqual(response.status_code, 200)
+
+            response = self.client.get('/api/songs',
+                headers = [('Accept', 'application/json')]
+            )
+        limits.reset()
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(response.headers.get('Retry-After'), '10')
+
+    def test_admission_limit(self):
+        ''' requests beyond the concurrency limit are shed with a 503 '''
+        with mock.patch.dict(app.config, {'ADMISSION_LIMITS': {'upload': 1}}):
+            limits.reset()
+            gate = limits.gate('upload')
+            # hold the only slot, as a slow upload in another thread would
+            gate.acquire()
+            response = self.client.post('/api/files',
+                data = {'file': (BytesIO(b'File contents'), 'test.txt')},
+                content_type = 'multipart/form-data',
+                headers = [('Accept', 'application/json')]
+            )
+            gate.release()
+
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers.get('Retry-After'), '1')
+            data = json.loads(response.data.decode('ascii'))
+            self.assertEqual(data['message'],
+                'Server is busy, please try again later')
+
+            response = self.client.post('/api/files',
+                data = {'file': (BytesIO(b'File contents'), 'test.txt')},
+                content_type = 'multipart/form-data',
+                headers = [('Accept', 'application/json')]
+            )
+            self.assertEqual(response.status_code, 201)
+        limits.reset()
+
+    def test_rate_limit_store_busy(self):
+        ''' a shared store which can't be locked in time sheds the request
+        rather than failing it '''
+        store = mock.Mock()
+        store.take.side_effect = limits.StoreBusy('database is locked')
+        with mock.patch.dict(app.config, {'RATE_LIMITS': {'list': (1, 1)}}), \
+            mock.patch.object(limits, 'store', return_value = store):
+            response = self.client.get('/api/songs',
+                headers = [('Accept', 'application/json')]
+            )
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers.get('Retry-After'), '1')
+
+    def test_rate_limit_client_header(self):
+        ''' behind a proxy clients are told apart by the header it sets '''
+        config = {
+            'RATE_LIMITS': {'list': (0.1, 1)},
+            'RATE_LIMIT_CLIENT_HEADER': 'X-Forwarded-For'
+        }
+        with mock.patch.dict(app.config, config):
+            limits.reset()
+            statuses = []
+            for address in ['1.1.1.1', '2.2.2.2', '9.9.9.9, 2.2.2.2']:
+                response = self.client.get('/api/songs',
+                    headers = [('Accept', 'application/json'),
+                        ('X-Forwarded-For', address)]
+                )
+                statuses.append(response.status_code)
+        limits.reset()
+
+        # the last client forged an address, but is keyed on the one the
+        # proxy appended
+        self.assertEqual(statuses, [200, 200, 429])
+
+    def test_memory_rate_limit_store_prunes_full_buckets(self):
+        store = limits.MemoryBucketStore()
+        store.take('idle', 1000, 1)
+        store.take('busy', 0.001, 2)
+
+        store.prune(time.monotonic() + 1)
+
+        self.assertEqual(list(store.buckets), ['busy'])
+
+    def test_shared_rate_limit_store(self):
+        ''' buckets in a SQLite store are shared between store instances,
+        as they would be between worker processes '''
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'limits.db')
+            first = limits.SqliteBucketStore(path)
+            second = limits.SqliteBucketStore(path)
+
+            self.assertTrue(first.take('client', 0.1, 2)[0])
+            self.assertTrue(second.take('client', 0.1, 2)[0])
+            allowed, retry_after = first.take('client', 0.1, 2)
+            self.assertFalse(allowed)
+            self.assertGreater(retry_after, 0)
+        finally:
+            shutil.rmtree(directory)
+
+    def make_wav(self, seconds = 1, rate = 44100):
+        ''' a stereo 16 bit WAV file of silence '''
+        data = BytesIO()
+        wav = wave.open(data, 'wb')
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(b'\x00' * 4 * rate * seconds)
+        wav.close()
+        return data.getvalue()
+
+    def add_wav_song(self, contents):
+        response = self.client.post('/api/files',
+            data = {'file': (BytesIO(contents), 'test.wav')},
+            content_type = 'multipart/form-data',
+            headers = [('Accept', 'application/json')]
+        )
+        self.assertEqual(response.status_code, 201)
+        file = session.query(models.File).get(1)
+        song = models.Song(file = file)
+        session.add(song)
+        session.commit()
+        return song
+
+    @unittest.skipIf(previews.numpy is None, 'numpy is required')
+    def test_song_preview(self):
+        contents = self.make_wav()
+        song = self.add_wav_song(contents)
+        previews.generate(song.file).result()
+
+        response = self.client.get('/api/songs/1/preview')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'audio/wav')
+        self.assertLess(len(response.data), len(contents) / 10)
+
+        wav = wave.open(BytesIO(response.data), 'rb')
+        self.assertEqual(wav.getnchannels(), 1)
+        self.assertEqual(wav.getsampwidth(), 1)
+        self.assertEqual(wav.getframerate(), 11025)
+        self.assertEqual(wav.getnframes(), 11025)
+
+    @unittest.skipIf(previews.numpy is None, 'numpy is required')
+    def test_song_preview_range(self):
+        song = self.add_wav_song(self.make_wav())
+        previews.generate(song.file).result()
+
+        response = self.client.get('/api/songs/1/preview',
+            headers = [('Range', 'bytes=0-99')]
+        )
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(len(response.data), 100)
+        self.assertEqual(response.data[:4], b'RIFF')
+
+    def test_song_preview_pending(self):
+        ''' a preview which hasn't been made yet is started in the
+        background and the client told to try again '''
+        file = models.File(filename = 'Test Song.wav')
+        song = models.Song(file = file)
+        session.add_all([file, song])
+        session.commit()
+
+        with mock.patch.object(previews, 'generate') as generate, \
+            mock.patch.object(previews, 'available', return_value = True):
+            response = self.client.get('/api/songs/1/preview')
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.headers.get('Retry-After'), '1')
+        generate.assert_called_once_with(file)
+
+    def test_song_preview_queue_full(self):
+        ''' previews aren't queued without limit '''
+        file = models.File(filename = 'Test Song.wav')
+        song = models.Song(file = file)
+        session.add_all([file, song])
+        session.commit()
+
+        with mock.patch.dict(app.config, {'PREVIEW_QUEUE_SIZE': 0}), \
+            mock.patch.object(previews, 'available', return_value = True):
+            response = self.client.get('/api/songs/1/preview')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers.get('Retry-After'), '5')
+
+    @unittest.skipIf(previews.numpy is None, 'numpy is required')
+    def test_transcode_in_blocks(self):
+        ''' the preview doesn't depend on how the original is split into
+        blocks while it is read '''
+        rate = 44100
+        times = previews.numpy.arange(rate * 2) / float(rate)
+        tone = previews.numpy.sin(2 * previews.numpy.pi * 440 * times)
+        frames = previews.numpy.repeat(tone * 2 ** 14, 2).astype('<i2')
+        data = BytesIO()
+        wav = wave.open(data, 'wb')
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(frames.tobytes())
+        wav.close()
+
+        results = []
+        for block in [1000, 4096, rate * 4]:
+            preview = BytesIO()
+            with mock.patch.object(previews, 'BLOCK_FRAMES', block):
+                previews.transcode(BytesIO(data.getvalue()), preview)
+            preview.seek(0)
+            wav = wave.open(preview, 'rb')
+            results.append(previews.numpy.frombuffer(
+                wav.readframes(wav.getnframes()), previews.numpy.uint8)
+                .astype(int))
+
+        self.assertEqual(len(results[0]), rate // 4 * 2)
+        for result in results[1:]:
+            self.assertEqual(len(result), len(results[0]))
+            # allow for rounding differences at quantization
+            self.assertLessEqual(abs(result - results[0]).max(), 1)
+
+    def test_transcode_with_unsupported_width(self):
+        for width in [3, 4]:
+            with self.assertRaises(ValueError):
+                previews.transcode(BytesIO(self.make_wav()), BytesIO(),
+                    width = width)
+
+    def test_failed_preview_is_retried(self):
+        ''' a preview which failed is only held back for a while '''
+        file = models.File(id = 7, filename = 'Test Song.wav')
+        now = time.monotonic()
+
+        with mock.patch.object(previews, 'numpy', mock.Mock()), \
+            mock.patch.dict(app.config, {'PREVIEW_RETRY_AFTER': 60}):
+            previews.failed(7)
+            self.assertFalse(previews.available(file))
+            with mock.patch.object(previews.time, 'monotonic',
+                return_value = now + 61):
+                self.assertTrue(previews.available(file))
+        previews._failed.clear()
+
+    def test_failed_previews_are_bounded(self):
+        with mock.patch.dict(app.config, {'PREVIEW_FAILURES_KEPT': 3}):
+            for file_id in range(10):
+                previews.failed(file_id)
+
+            self.assertEqual(sorted(previews._failed), [7, 8, 9])
+        previews._failed.clear()
+
+    def test_failed_preview_is_logged(self):
+        with self.assertLogs(app.logger, 'ERROR') as logs:
+            with self.assertRaises(IOError):
+                previews.render(7, 'Missing Song.wav')
+
+        self.assertIn('Could not create a preview of file 7', logs.output[0])
+        self.assertIn(7, previews._failed)
+        previews._failed.clear()
+
+    def test_song_preview_without_wav(self):
+        file = models.File(filename = 'Test Song.mp3')
+        song = models.Song(file = file)
+        session.add_all([file, song])
+        session.commit()
+
+        response = self.client.get('/api/songs/1/preview')
+
+        self.assertEqual(response.status_code, 404)
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['message'],
+            'No preview is available for song with id 1')
+
+    def test_song_preview_with_nonexistent_id(self):
+        response = self.client.get('/api/songs/8/preview')
+
+        self.assertEqual(response.status_code, 404)
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['message'], 'Could not find song with id 8')
+
+    def test_preview_cache_eviction(self):
+        ''' the least recently used previews are deleted to stay under
+        the byte budget '''
+        directory = tempfile.mkdtemp()
+        try:
+            cache = previews.PreviewCache(directory, 250)
+            def write(path):
+                with open(path, 'wb') as f:
+                    f.write(b'x' * 100)
+
+            cache.put(1, write)
+            cache.put(2, write)
+            os.utime(cache.path(1), (1, 1))
+            os.utime(cache.path(2), (2, 2))
+            # using the first preview makes the second the least recent
+            self.assertEqual(cache.get(1), cache.path(1))
+            cache.put(3, write)
+
+            self.assertIsNotNone(cache.get(1))
+            self.assertIsNone(cache.get(2))
+            self.assertIsNotNone(cache.get(3))
+        finally:
+            shutil.rmtree(directory)
+
+@unittest.skipIf(mock_aws is None, 'boto3 and moto are required')
+class TestS3Storage(unittest.TestCase):
+    """ Tests for direct uploads to an S3-compatible store """
+
+    def setUp(self):
+        """ Test setup """
+        self.client = app.test_client()
+        Base.metadata.create_all(engine)
+
+        self.mock = mock_aws()
+        self.mock.start()
+        self.s3 = boto3.client('s3', region_name = 'us-east-1')
+        self.s3.create_bucket(Bucket = 'tuneful-test')
+        self.storage = S3Storage('tuneful-test', client = self.s3)
+        self.patch = mock.patch('tuneful.api.storage', self.storage)
+        self.patch.start()
+
+    def tearDown(self):
+        """ Test teardown """
+        self.patch.stop()
+        self.mock.stop()
+        session.close()
+        Base.metadata.drop_all(engine)
+
+    def start_upload(self, name):
+        return self.client.post('/api/files/uploads',
+            data = json.dumps({'name': name}),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json')]
+        )
+
+    def finalize_upload(self, name, token):
+        return self.client.post('/api/files/uploads/finalize',
+            data = json.dumps({'name': name, 'token': token}),
+            content_type = 'application/json',
+            headers = [('Accept', 'application/json')]
+        )
+
+    def test_direct_upload(self):
+        response = self.start_upload('test.txt')
+
+        self.assertEqual(response.status_code, 201)
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['name'], 'test.txt')
+        self.assertEqual(data['method'], 'PUT')
+        self.assertIn(self.storage.key('test.txt'), data['url'])
+        self.assertIn('Signature', data['url'])
+
+        # stand in for the client PUTting to the presigned URL
+        self.s3.put_object(Bucket = 'tuneful-test',
+            Key = self.storage.key('test.txt'), Body = b'File contents')
+
+        response = self.finalize_upload('test.txt', data['token'])
+
+        self.assertEqual(response.status_code, 201)
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['name'], 'test.txt')
+        self.assertEqual(urlparse(data['path']).path, '/uploads/test.txt')
+
+        files = session.query(models.File).all()
+        self.assertEqual(len(files), 1)
+        self.assertEqual(files[0].filename, 'test.txt')
+
+    def test_direct_upload_with_existing_name(self):
+        self.s3.put_object(Bucket = 'tuneful-test',
+            Key = self.storage.key('test.txt'), Body = b'File contents')
+
+        response = self.start_upload('test.txt')
+
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['name'], 'test-1.txt')
+
+    def test_direct_upload_with_pending_name(self):
+        ''' a name handed out for an unfinished upload is not handed out
+        again, even though nothing has been uploaded under it yet '''
+        first = json.loads(self.start_upload('test.txt').data.decode('ascii'))
+        second = json.loads(self.start_upload('test.txt').data.decode('ascii'))
+
+        self.assertEqual(first['name'], 'test.txt')
+        self.assertEqual(second['name'], 'test-1.txt')
+        self.assertNotEqual(first['url'], second['url'])
+
+    def test_finalize_missing_upload(self):
+        data = json.loads(self.start_upload('test.txt').data.decode('ascii'))
+
+        response = self.finalize_upload('test.txt', data['token'])
+
+        self.assertEqual(response.status_code, 404)
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['message'],
+            'Could not find uploaded data for test.txt')
+        self.assertEqual(session.query(models.File).count(), 0)
+
+    def test_finalize_name_not_issued(self):
+        ''' objects which weren't uploaded through file_upload_post can't
+        be finalized '''
+        self.s3.put_object(Bucket = 'tuneful-test',
+            Key = self.storage.key('test.txt'), Body = b'File contents')
+
+        response = self.finalize_upload('test.txt', 'guess')
+
+        self.assertEqual(response.status_code, 404)
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['message'],
+            'Could not find a pending upload named test.txt')
+        self.assertEqual(session.query(models.File).count(), 0)
+
+    def test_finalize_invalid_name(self):
+        for name in ['../config.py', '/etc/passwd', '']:
+            response = self.finalize_upload(name, 'guess')
+
+            self.assertEqual(response.status_code, 422)
+            data = json.loads(response.data.decode('ascii'))
+            self.assertEqual(data['message'], 'Invalid file name')
+        self.assertEqual(session.query(models.File).count(), 0)
+
+    def test_finalize_upload_twice(self):
+        data = json.loads(self.start_upload('test.txt').data.decode('ascii'))
+        self.s3.put_object(Bucket = 'tuneful-test',
+            Key = self.storage.key('test.txt'), Body = b'File contents')
+
+        response = self.finalize_upload('test.txt', data['token'])
+        self.assertEqual(response.status_code, 201)
+        response = self.finalize_upload('test.txt', data['token'])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(session.query(models.File).count(), 1)
+
+    def test_finalize_with_wrong_token(self):
+        ''' only the client a name was handed to can finalize it '''
+        self.start_upload('test.txt')
+        self.s3.put_object(Bucket = 'tuneful-test',
+            Key = self.storage.key('test.txt'), Body = b'File contents')
+
+        response = self.finalize_upload('test.txt', 'guess')
+
+        self.assertEqual(response.status_code, 403)
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['message'], 'Invalid token for upload test.txt')
+        self.assertEqual(session.query(models.File).count(), 0)
+
+    def test_finalize_expired_upload(self):
+        data = json.loads(self.start_upload('test.txt').data.decode('ascii'))
+        self.s3.put_object(Bucket = 'tuneful-test',
+            Key = self.storage.key('test.txt'), Body = b'File contents')
+        upload = session.query(models.Upload).one()
+        upload.created -= datetime.timedelta(
+            seconds = self.storage.upload_expiry + 1)
+        session.commit()
+
+        response = self.finalize_upload('test.txt', data['token'])
+
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(session.query(models.File).count(), 0)
+        self.assertEqual(session.query(models.Upload).count(), 0)
+
+    def test_expired_reservation_is_released(self):
+        ''' a name abandoned by its uploader is handed out again once its
+        upload URL has expired '''
+        self.start_upload('test.txt')
+        upload = session.query(models.Upload).one()
+        upload.created -= datetime.timedelta(
+            seconds = self.storage.upload_expiry + 1)
+        session.commit()
+
+        data = json.loads(self.start_upload('test.txt').data.decode('ascii'))
+
+        self.assertEqual(data['name'], 'test.txt')
+        self.assertEqual(session.query(models.Upload).count(), 1)
+
+    def test_file_upload_skips_reserved_name(self):
+        ''' uploads through the app don't take a name reserved for a
+        direct upload '''
+        reserved = json.loads(
+            self.start_upload('test.txt').data.decode('ascii'))
+
+        response = self.client.post('/api/files',
+            data = {'file': (BytesIO(b'Through the app'), 'test.txt')},
+            content_type = 'multipart/form-data',
+            headers = [('Accept', 'application/json')]
+        )
+
+        self.assertEqual(response.status_code, 201)
+        data = json.loads(response.data.decode('ascii'))
+        self.assertEqual(data['name'], 'test-1.txt')
+
+        # the direct upload then completes under its own name
+        self.s3.put_object(Bucket = 'tuneful-test',
+            Key = self.storage.key('test.txt'), Body = b'Direct')
+        response = self.finalize_upload('test.txt', reserved['token'])
+        self.assertEqual(response.status_code, 201)
+
+        body = self.s3.get_object(Bucket = 'tuneful-test',
+            Key = self.storage.key('test-1.txt'))['Body'].read()
+        self.assertEqual(body, b'Through the app')
+        self.assertEqual(session.query(models.Upload).count(), 0)
+
+    def test_get_uploaded_file_redirects(self):
+        self.s3.put_object(Bucket = 'tuneful-test',
+            Key = self.storage.key('test.txt'), Body = b'File contents')
+
+        response = self.client.get('/uploads/test.txt')
+
+        self.assertEqual(response.status_code, 302)
+        location = response.headers.get('Location')
+        self.assertIn(self.storage.key('test.txt'), location)
+        self.assertIn('Signature', location)
+
@@ -0,0 +1,336 @@
+import unittest
+import os
+import shutil
+import json
+from io import BytesIO
+from contextlib import contextmanager
+from unittest import mock
+
+# Configure our app to use the testing databse
+os.environ["CONFIG_PATH"] = "tuneful.config.TestingConfig"
+
+from sqlalchemy import event, text
+
+from tuneful import app
+from tuneful import models
+from tuneful.storage import Storage
+from tuneful.utils import upload_path
+from tuneful.database import Base, engine, session
+
+@contextmanager
+def count_queries():
+    '''
+    record the SQL statements sent to the database inside the block, as
+    (statement, parameters) pairs; statements run with executemany have
+    their parameters recorded as None
+    '''
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, None if executemany else parameters))
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+class DirectStorage(Storage):
+    """
+    Stands in for an object store, so the direct upload endpoints can be
+    called without one
+    """
+    direct_uploads = True
+    upload_expiry = 900
+
+    def __init__(self):
+        super(DirectStorage, self).__init__()
+        self.uploaded = set()
+
+    def exists(self, filename):
+        return filename in self.uploaded
+
+    def upload_url(self, filename):
+        return 'https://storage.example.com/' + self.key(filename)
+
+class TestQueryCounts(unittest.TestCase):
+    """ Guards against endpoints making more queries than they need to """
+
+    def setUp(self):
+        """ Test setup """
+        self.client = app.test_client()
+        Base.metadata.create_all(engine)
+        os.mkdir(upload_path())
+
+    def tearDown(self):
+        """ Test teardown """
+        session.close()
+        Base.metadata.drop_all(engine)
+        shutil.rmtree(upload_path())
+
+    def add_songs(self, count):
+        for i in range(count):
+            file = models.File(filename = 'Test Song {}.mp3'.format(i))
+            session.add_all([file, models.Song(file = file)])
+        session.commit()
+        # start the request with nothing cached in the session
+        session.expire_all()
+
+    def assertMaxQueries(self, maximum, statements):
+        self.assertLessEqual(len(statements), maximum,
+            'Expected at most {} queries, got {}:\n{}'.format(maximum,
+                len(statements), '\n'.join(statement
+                    for statement, parameters in statements)))
+
+    def test_get_songs(self):
+        ''' the song list takes the same number of queries however
+        many songs there are '''
+        self.add_songs(20)
+
+        with count_queries() as statements:
+            response = self.client.get('/api/songs',
+                headers = [('Accept', 'application/json')]
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data.decode('ascii'))), 20)
+        self.assertMaxQueries(1, statements)
+
+    def test_get_song(self):
+        self.add_songs(1)
+
+        with count_queries() as statements:
+            response = self.client.get('/api/songs/1',
+                headers = [('Accept', 'application/json')]
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertMaxQueries(2, statements)
+
+    def test_post_song(self):
+        file = models.File(filename = 'Test Song.mp3')
+        session.add(file)
+        session.commit()
+        session.expire_all()
+
+        with count_queries() as statements:
+            response = self.client.post('/api/songs',
+                data = json.dumps({'file': {'id': 1}}),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertMaxQueries(5, statements)
+
+    def test_put_song(self):
+        self.add_songs(2)
+
+        with count_queries() as statements:
+            response = self.client.put('/api/songs/1',
+                data = json.dumps({'file': {'id': 2}}),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertMaxQueries(7, statements)
+
+    def test_file_upload(self):
+        with count_queries() as statements:
+            response = self.client.post('/api/files',
+                data = {'file': (BytesIO(b'File contents'), 'test.txt')},
+                content_type = 'multipart/form-data',
+                headers = [('Accept', 'application/json')]
+            )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertMaxQueries(2, statements)
+
+    def test_delete_song(self):
+        self.add_songs(1)
+
+        with count_queries() as statements:
+            response = self.client.delete('/api/songs/1',
+                data = json.dumps({}),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(session.query(models.Song).count(), 0)
+        # the song, its file through the backref, unlinking the file, then
+        # deleting the song
+        self.assertMaxQueries(4, statements)
+
+    def test_song_preview(self):
+        self.add_songs(1)
+
+        with count_queries() as statements:
+            response = self.client.get('/api/songs/1/preview')
+
+        # the file is an mp3, so has no preview, but the song and its file
+        # still have to be looked up to find that out
+        self.assertEqual(response.status_code, 404)
+        self.assertMaxQueries(2, statements)
+
+    def test_get_uploaded_file(self):
+        with open(upload_path('test.txt'), 'wb') as f:
+            f.write(b'File contents')
+
+        with count_queries() as statements:
+            response = self.client.get('/uploads/test.txt')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertMaxQueries(0, statements)
+
+    def test_direct_upload(self):
+        with mock.patch('tuneful.api.storage', DirectStorage()):
+            with count_queries() as statements:
+                response = self.client.post('/api/files/uploads',
+                    data = json.dumps({'name': 'test.txt'}),
+                    content_type = 'application/json',
+                    headers = [('Accept', 'application/json')]
+                )
+
+        self.assertEqual(response.status_code, 201)
+        # clearing expired reservations, then reserving the name
+        self.assertMaxQueries(2, statements)
+
+    def test_finalize_upload(self):
+        storage = DirectStorage()
+        storage.uploaded.add('test.txt')
+        session.add(models.Upload(filename = 'test.txt', token = 'secret'))
+        session.commit()
+        session.expire_all()
+
+        with mock.patch('tuneful.api.storage', storage):
+            with count_queries() as statements:
+                response = self.client.post('/api/files/uploads/finalize',
+                    data = json.dumps({'name': 'test.txt', 'token': 'secret'}),
+                    content_type = 'application/json',
+                    headers = [('Accept', 'application/json')]
+                )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertMaxQueries(4, statements)
+
+@unittest.skipIf(engine.dialect.name != 'postgresql',
+    'query plans are only checked on Postgres')
+class TestQueryPlans(unittest.TestCase):
+    """
+    Checks that the statements endpoints send to the database use an index.
+    The tables are seeded with enough rows that Postgres would rather scan an
+    index than the whole table, if a suitable index exists.  The song list
+    is left out, as it returns every row and has to scan the tables.
+    """
+    rows = 20000
+
+    def setUp(self):
+        """ Test setup """
+        self.client = app.test_client()
+        Base.metadata.create_all(engine)
+        os.mkdir(upload_path())
+        session.execute(models.Song.__table__.insert(),
+            [{'id': i} for i in range(1, self.rows + 1)])
+        session.execute(models.File.__table__.insert(),
+            [{'id': i, 'filename': 'Test Song {}.mp3'.format(i), 'song_id': i}
+                for i in range(1, self.rows + 1)])
+        session.execute(models.Upload.__table__.insert(),
+            [{'id': i, 'filename': 'Upload {}.mp3'.format(i),
+                'token': 'secret'}
+                for i in range(1, self.rows + 1)])
+        # the rows were given ids, so move the sequences past them
+        for table in ['songs', 'files', 'uploads']:
+            session.execute(text("SELECT setval('{0}_id_seq', "
+                "(SELECT max(id) FROM {0}))".format(table)))
+        session.commit()
+        for table in ['songs', 'files', 'uploads']:
+            session.execute(text('ANALYZE {}'.format(table)))
+        session.commit()
+
+    def tearDown(self):
+        """ Test teardown """
+        session.close()
+        Base.metadata.drop_all(engine)
+        shutil.rmtree(upload_path())
+
+    def assertNoSeqScan(self, statements):
+        self.assertTrue(statements)
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for statement, parameters in statements:
+                if parameters is None:
+                    continue
+                cursor.execute('EXPLAIN ' + statement, parameters)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+                self.assertNotIn('Seq Scan', plan,
+                    'Sequential scan in plan for:\n{}\n{}'.format(statement,
+                        plan))
+        finally:
+            connection.close()
+
+    def test_get_song(self):
+        with count_queries() as statements:
+            response = self.client.get('/api/songs/500',
+                headers = [('Accept', 'application/json')]
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNoSeqScan(statements)
+
+    def test_post_song(self):
+        with count_queries() as statements:
+            response = self.client.post('/api/songs',
+                data = json.dumps({'file': {'id': 500}}),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertNoSeqScan(statements)
+
+    def test_put_song(self):
+        with count_queries() as statements:
+            response = self.client.put('/api/songs/500',
+                data = json.dumps({'file': {'id': 501}}),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNoSeqScan(statements)
+
+    def test_delete_song(self):
+        with count_queries() as statements:
+            response = self.client.delete('/api/songs/500',
+                data = json.dumps({}),
+                content_type = 'application/json',
+                headers = [('Accept', 'application/json')]
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(session.query(models.Song).get(500))
+        self.assertNoSeqScan(statements)
+
+    def test_song_preview(self):
+        with count_queries() as statements:
+            response = self.client.get('/api/songs/500/preview')
+
+        self.assertEqual(response.status_code, 404)
+        self.assertNoSeqScan(statements)
+
+    def test_finalize_upload(self):
+        storage = DirectStorage()
+        storage.uploaded.add('Upload 500.mp3')
+
+        with mock.patch('tuneful.api.storage', storage):
+            with count_queries() as statements:
+                response = self.client.post('/api/files/uploads/finalize',
+                    data = json.dumps({'name': 'Upload 500.mp3',
+                        'token': 'secret'}),
+                    content_type = 'application/json',
+                    headers = [('Accept', 'application/json')]
+                )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertNoSeqScan(statements)
@@ -1,15 +1,21 @@
 import os.path
 import json
+import datetime
+import hmac
+import uuid
 
-from flask import request, Response, url_for, send_from_directory
+from flask import request, Response, url_for, send_file
 from werkzeug.utils import secure_filename
 from jsonschema import validate, ValidationError
+from sqlalchemy.exc import IntegrityError
 
 from . import models
 from . import decorators
+from . import serializers
+from . import previews
 from tuneful import app
 from .database import session
-from .utils import upload_path
+from .storage import storage
 
 song_schema = {
     "properties": {
@@ -26,16 +32,80 @@ song_schema = {
     "required": ["file"]
 }
 
+upload_schema = {
+    "properties": {
+        "name": {
+            "type": "string"
+        }
+    },
+    "required": ["name"]
+}
+
+finalize_schema = {
+    "properties": {
+        "name": {
+            "type": "string"
+        },
+        "token": {
+            "type": "string"
+        }
+    },
+    "required": ["name", "token"]
+}
+
+def reserve_name(filename):
+    '''
+    reserve the first free variant of a filename for an upload to the object
+    store, returning the `models.Upload` holding it.  Every upload to the
+    store takes its name here, so two can never be given the same one.
+    Reservations which have outlived their presigned upload URL are cleared
+    first; nothing can be uploaded under them any more.
+    '''
+    expired = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds = storage.upload_expiry)
+    session.query(models.Upload).filter(
+        models.Upload.created < expired).delete()
+    session.commit()
+
+    for candidate in storage.candidates(filename):
+        if storage.exists(candidate):
+            continue
+        upload = models.Upload(filename = candidate,
+            token = uuid.uuid4().hex)
+        session.add(upload)
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            continue
+        return upload
+
 @app.route('/api/songs', methods = ['GET'])
+@decorators.rate_limit('list')
+@decorators.admit('list')
 @decorators.accept('application/json')
 def songs_get():
     ''' get a list of songs '''
-    
-    songs = session.query(models.Song)
-    songs = songs.order_by(models.Song.id)
+    embed = request.args.get('embed', 'file')
+    format = request.args.get('format', 'objects')
+    try:
+        fields = serializers.select_song_fields(request.args.get('fields'),
+            embed)
+        serializers.check_format(format)
+    except ValueError as error:
+        data = {'message': str(error)}
+        return Response(json.dumps(data), 422, mimetype = 'application/json')
 
-    data = json.dumps([song.as_dictionary() for song in songs])
-    return Response(data, 200, mimetype = 'application/json')
+    # only the columns behind the requested fields are queried, with each
+    # song's file joined in the same query rather than one query per song
+    songs = serializers.query_songs(session, fields)
+
+    if format == 'columnar':
+        data = serializers.songs_columnar(songs, fields, embed)
+    else:
+        data = [serializers.song_dictionary(song, fields, embed)
+            for song in songs]
+    return Response(json.dumps(data), 200, mimetype = 'application/json')
 
 @app.route('/api/songs/<int:id>', methods = ['GET'])
 @decorators.accept('application/json')
@@ -134,16 +204,54 @@ def songs_delete(id):
         return Response(data, 404, mimetype = 'application/json')
     
     session.delete(song)
+    session.commit()
     
     message = 'Successfully deleted song with id {}'.format(id)
     data = json.dumps({'message': message})
     return Response(data, 200, mimetype = 'application/json')
     
+@app.route('/api/songs/<int:id>/preview', methods = ['GET'])
+def song_preview(id):
+    ''' get a small preview of a song's audio '''
+    song = session.query(models.Song).get(id)
+    if not song:
+        message = 'Could not find song with id {}'.format(id)
+        data = json.dumps({'message': message})
+        return Response(data, 404, mimetype = 'application/json')
+
+    path = previews.cache.get(song.file.id) if song.file else None
+    if path:
+        try:
+            return send_file(path, mimetype = 'audio/wav', conditional = True)
+        except FileNotFoundError:
+            # evicted since we looked it up, so make it again
+            pass
+
+    if not song.file or not previews.available(song.file):
+        message = 'No preview is available for song with id {}'.format(id)
+        data = json.dumps({'message': message})
+        return Response(data, 404, mimetype = 'application/json')
+
+    # return a 202 Accepted while the preview is made in the background, or
+    # a 503 if too many previews are already waiting to be made
+    if previews.generate(song.file) is None:
+        message = 'Too many previews are being created, try again later'
+        data = json.dumps({'message': message})
+        headers = {'Retry-After': '5'}
+        return Response(data, 503, headers = headers,
+            mimetype = 'application/json')
+    message = 'Preview for song with id {} is being created'.format(id)
+    data = json.dumps({'message': message})
+    headers = {'Retry-After': '1'}
+    return Response(data, 202, headers = headers, mimetype = 'application/json')
+
 @app.route('/uploads/<filename>', methods = ['GET'])
 def uploaded_file(filename):
-    return send_from_directory(upload_path(), filename)
+    return storage.send(filename)
     
 @app.route('/api/files', methods = ['POST'])
+@decorators.rate_limit('upload')
+@decorators.admit('upload')
 @decorators.require('multipart/form-data')
 @decorators.accept('application/json')
 def file_post():
@@ -153,10 +261,116 @@ def file_post():
         return Response(json.dumps(data), 422, mimetype = 'application/json')
         
     filename = secure_filename(file.filename)
+    if not filename:
+        data = {'message': 'Invalid file name'}
+        return Response(json.dumps(data), 422, mimetype = 'application/json')
+
+    if storage.direct_uploads:
+        # direct uploads write to the same store, so take the name through
+        # the same reservations they do
+        upload = reserve_name(filename)
+        filename = storage.save(file, upload.filename)
+        session.delete(upload)
+    else:
+        filename = storage.save(file, filename)
     db_file = models.File(filename = filename)
     session.add(db_file)
     session.commit()
-    file.save(upload_path(filename))
+    if previews.available(db_file):
+        previews.generate(db_file)
     
     data = db_file.as_dictionary()
-    return Response(json.dumps(data), 201, mimetype = 'application/json')
\ No newline at end of file
+    return Response(json.dumps(data), 201, mimetype = 'application/json')
+
+@app.route('/api/files/uploads', methods = ['POST'])
+@decorators.rate_limit('upload')
+@decorators.accept('application/json')
+@decorators.require('application/json')
+def file_upload_post():
+    ''' start a direct upload, returning a presigned URL for the file data '''
+    data = request.json
+
+    if not storage.direct_uploads:
+        data = {'message': 'Direct uploads are not supported by this server'}
+        return Response(json.dumps(data), 501, mimetype = 'application/json')
+
+    try:
+        validate(data, upload_schema)
+    except ValidationError as error:
+        data = {'message': error.message}
+        return Response(json.dumps(data), 422, mimetype = 'application/json')
+
+    filename = secure_filename(data['name'])
+    if not filename:
+        data = {'message': 'Invalid file name'}
+        return Response(json.dumps(data), 422, mimetype = 'application/json')
+
+    # the token proves to file_upload_finalize that the caller is the
+    # client the name was handed to
+    upload = reserve_name(filename)
+    data = {
+        'name': upload.filename,
+        'token': upload.token,
+        'method': 'PUT',
+        'url': storage.upload_url(upload.filename)
+    }
+    return Response(json.dumps(data), 201, mimetype = 'application/json')
+
+@app.route('/api/files/uploads/finalize', methods = ['POST'])
+@decorators.accept('application/json')
+@decorators.require('application/json')
+def file_upload_finalize():
+    ''' record a file once its direct upload has completed '''
+    data = request.json
+
+    if not storage.direct_uploads:
+        data = {'message': 'Direct uploads are not supported by this server'}
+        return Response(json.dumps(data), 501, mimetype = 'application/json')
+
+    try:
+        validate(data, finalize_schema)
+    except ValidationError as error:
+        data = {'message': error.message}
+        return Response(json.dumps(data), 422, mimetype = 'application/json')
+
+    filename = data['name']
+    if not filename or secure_filename(filename) != filename:
+        data = {'message': 'Invalid file name'}
+        return Response(json.dumps(data), 422, mimetype = 'application/json')
+
+    # only names handed out by file_upload_post can be finalized
+    upload = session.query(models.Upload).filter(
+        models.Upload.filename == filename).first()
+    if not upload:
+        message = 'Could not find a pending upload named {}'.format(filename)
+        data = json.dumps({'message': message})
+        return Response(data, 404, mimetype = 'application/json')
+
+    if not hmac.compare_digest(upload.token, data['token']):
+        message = 'Invalid token for upload {}'.format(filename)
+        data = json.dumps({'message': message})
+        return Response(data, 403, mimetype = 'application/json')
+
+    expired = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds = storage.upload_expiry)
+    if upload.created < expired:
+        session.delete(upload)
+        session.commit()
+        message = 'Upload {} has expired'.format(filename)
+        data = json.dumps({'message': message})
+        return Response(data, 410, mimetype = 'application/json')
+
+    if not storage.exists(filename):
+        message = 'Could not find uploaded data for {}'.format(filename)
+        data = json.dumps({'message': message})
+        return Response(data, 404, mimetype = 'application/json')
+
+    db_file = models.File(filename = filename)
+    session.delete(upload)
+    session.add(db_file)
+    session.commit()
+    if previews.available(db_file):
+        previews.generate(db_file)
+
+    data = db_file.as_dictionary()
+    return Response(json.dumps(data), 201, mimetype = 'application/json')
@@ -1,8 +1,12 @@
 import json
+import math
 from functools import wraps
 
 from flask import request, Response
 
+from tuneful import app
+from . import limits
+
 def accept(mimetype):
     def decorator(func):
         """
@@ -34,3 +38,60 @@ def require(mimetype):
             return Response(data, 415, mimetype="application/json")
         return wrapper
     return decorator
+
+def admit(route_class):
+    def decorator(func):
+        """
+        Decorator which returns a 503 Service Unavailable if too many requests
+        of a certain class are already being handled
+        """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            gate = limits.gate(route_class)
+            if gate is None:
+                return func(*args, **kwargs)
+            if gate.acquire(blocking=False):
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    gate.release()
+            message = "Server is busy, please try again later"
+            data = json.dumps({"message": message})
+            retry_after = app.config.get("ADMISSION_RETRY_AFTER", 1)
+            headers = {"Retry-After": str(retry_after)}
+            return Response(data, 503, headers=headers,
+                mimetype="application/json")
+        return wrapper
+    return decorator
+
+def rate_limit(route_class):
+    def decorator(func):
+        """
+        Decorator which returns a 429 Too Many Requests if the client has used
+        up its token bucket for a certain class of request
+        """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            limit = app.config.get("RATE_LIMITS", {}).get(route_class)
+            if limit is None:
+                return func(*args, **kwargs)
+            rate, capacity = limit
+            key = "{}:{}".format(route_class, limits.client_key(request))
+            try:
+                allowed, retry_after = limits.store().take(key, rate, capacity)
+            except limits.StoreBusy:
+                message = "Server is busy, please try again later"
+                data = json.dumps({"message": message})
+                retry_after = app.config.get("ADMISSION_RETRY_AFTER", 1)
+                headers = {"Retry-After": str(retry_after)}
+                return Response(data, 503, headers=headers,
+                    mimetype="application/json")
+            if allowed:
+                return func(*args, **kwargs)
+            message = "Too many requests, please try again later"
+            data = json.dumps({"message": message})
+            headers = {"Retry-After": str(int(math.ceil(retry_after)))}
+            return Response(data, 429, headers=headers,
+                mimetype="application/json")
+        return wrapper
+    return decorator
@@ -0,0 +1,153 @@
+import sqlite3
+import threading
+import time
+
+from tuneful import app
+
+# how often, in seconds, buckets which have refilled are thrown away; a
+# missing bucket is treated as full, so this only bounds memory and disk use
+PRUNE_INTERVAL = 60
+
+class StoreBusy(Exception):
+    """ Raised when a shared bucket store can't be locked in time """
+
+class MemoryBucketStore(object):
+    """
+    Keeps token bucket state in this process.  Each worker process gets its
+    own buckets, so a client's effective limit scales with the worker count.
+    """
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.pruned = time.monotonic()
+
+    def take(self, key, rate, capacity):
+        with self.lock:
+            now = time.monotonic()
+            tokens, updated = self.buckets.get(key, (capacity, None, None))[:2]
+            allowed, tokens, retry_after = refill(tokens, updated, now, rate,
+                capacity)
+            self.buckets[key] = (tokens, now, full_at(tokens, now, rate,
+                capacity))
+            if now - self.pruned >= PRUNE_INTERVAL:
+                self.prune(now)
+            return allowed, retry_after
+
+    def prune(self, now):
+        self.buckets = dict((key, bucket)
+            for key, bucket in self.buckets.items() if bucket[2] > now)
+        self.pruned = now
+
+class SqliteBucketStore(object):
+    """
+    Keeps token bucket state in a SQLite file so every worker process on the
+    host shares the same buckets.  As the processes share no clock but the
+    wall clock, time spent with the clock stepped back is not counted
+    towards refilling a bucket.
+    """
+    def __init__(self, path, timeout = 1):
+        self.path = path
+        self.timeout = timeout
+        self.pruned = time.time()
+        connection = self.connect()
+        connection.execute('CREATE TABLE IF NOT EXISTS buckets ('
+            'key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+            'updated REAL NOT NULL, full_at REAL NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_buckets_full_at '
+            'ON buckets (full_at)')
+        connection.close()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout = self.timeout,
+            isolation_level = None)
+
+    def take(self, key, rate, capacity):
+        try:
+            connection = self.connect()
+        except sqlite3.OperationalError as error:
+            raise StoreBusy(str(error))
+        try:
+            # take the write lock up front so the read and update are atomic
+            connection.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            row = connection.execute(
+                'SELECT tokens, updated FROM buckets WHERE key = ?',
+                (key,)).fetchone()
+            tokens, updated = row if row else (capacity, None)
+            allowed, tokens, retry_after = refill(tokens, updated, now, rate,
+                capacity)
+            connection.execute('INSERT OR REPLACE INTO buckets '
+                '(key, tokens, updated, full_at) VALUES (?, ?, ?, ?)',
+                (key, tokens, now, full_at(tokens, now, rate, capacity)))
+            if now - self.pruned >= PRUNE_INTERVAL:
+                connection.execute('DELETE FROM buckets WHERE full_at <= ?',
+                    (now,))
+                self.pruned = now
+            connection.execute('COMMIT')
+        except sqlite3.OperationalError as error:
+            # the database is locked by a burst of other workers
+            raise StoreBusy(str(error))
+        finally:
+            connection.close()
+        return allowed, retry_after
+
+def refill(tokens, updated, now, rate, capacity):
+    '''
+    top up a bucket for the time since it was last updated, then try to take
+    a token from it; returns whether a token was taken, the tokens left, and
+    the seconds until the next token is due
+    '''
+    if updated is not None:
+        tokens = min(capacity, tokens + max(0, now - updated) * rate)
+    if tokens >= 1:
+        return True, tokens - 1, 0
+    return False, tokens, (1 - tokens) / rate
+
+def full_at(tokens, now, rate, capacity):
+    ''' the time at which a bucket will have refilled to capacity '''
+    return now + (capacity - tokens) / rate
+
+_gates = {}
+_store = None
+_lock = threading.Lock()
+
+def gate(route_class):
+    '''
+    the semaphore capping concurrent requests for a route class, or None if
+    the class has no limit
+    '''
+    with _lock:
+        if route_class not in _gates:
+            limit = app.config.get('ADMISSION_LIMITS', {}).get(route_class)
+            _gates[route_class] = (threading.BoundedSemaphore(limit)
+                if limit else None)
+        return _gates[route_class]
+
+def store():
+    global _store
+    with _lock:
+        if _store is None:
+            path = app.config.get('RATE_LIMIT_STORE')
+            _store = SqliteBucketStore(path) if path else MemoryBucketStore()
+        return _store
+
+def client_key(request):
+    '''
+    identify the client making a request; by default its address, which is
+    the proxy's address when the app runs behind a reverse proxy, so set
+    RATE_LIMIT_CLIENT_HEADER to the header the proxy puts the client's
+    address in
+    '''
+    header = app.config.get('RATE_LIMIT_CLIENT_HEADER')
+    if header and request.headers.get(header):
+        # proxies append to X-Forwarded-For, so the last address is the one
+        # our own proxy saw; any earlier ones could be forged by the client
+        return request.headers[header].split(',')[-1].strip()
+    return request.remote_addr
+
+def reset():
+    ''' forget all limiter state so changes to the config take effect '''
+    global _store
+    with _lock:
+        _gates.clear()
+        _store = None
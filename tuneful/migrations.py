@@ -0,0 +1,45 @@
+from sqlalchemy import text
+
+# Schema changes for databases created before the change was made to the
+# models.  `create_all` only creates missing tables, so anything added to an
+# existing table goes here.  Run them with `python migrate_db.py`; each
+# migration must be safe to run repeatedly.
+
+def create_index(connection, name, table, column):
+    '''
+    create an index if it doesn't exist.  On Postgres the index is built
+    concurrently, so writes to the table carry on while it builds.
+    '''
+    if connection.dialect.name != 'postgresql':
+        connection.execute(text('CREATE INDEX IF NOT EXISTS {} ON {} ({})'
+            .format(name, table, column)))
+        return
+
+    # an interrupted concurrent build leaves an invalid index behind, which
+    # IF NOT EXISTS would otherwise skip over
+    valid = connection.execute(text('SELECT i.indisvalid FROM pg_class c '
+        'JOIN pg_index i ON i.indexrelid = c.oid WHERE c.relname = :name'),
+        {'name': name}).scalar()
+    if valid is False:
+        connection.execute(text('DROP INDEX CONCURRENTLY {}'.format(name)))
+    connection.execute(text('CREATE INDEX CONCURRENTLY IF NOT EXISTS {} '
+        'ON {} ({})'.format(name, table, column)))
+
+def add_file_indexes(connection):
+    ''' index the columns files are looked up by '''
+    create_index(connection, 'ix_files_song_id', 'files', 'song_id')
+
+MIGRATIONS = [
+    add_file_indexes,
+]
+
+def upgrade(engine, log = None):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction, so each
+    # statement is committed as it runs
+    with engine.connect() as connection:
+        connection = connection.execution_options(
+            isolation_level = 'AUTOCOMMIT')
+        for migration in MIGRATIONS:
+            if log:
+                log('Running {}'.format(migration.__name__))
+            migration(connection)
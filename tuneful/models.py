@@ -1,7 +1,8 @@
 import os.path
+import datetime
 
 from flask import url_for
-from sqlalchemy import Column, Integer, String, Sequence, ForeignKey
+from sqlalchemy import Column, Integer, String, Sequence, ForeignKey, DateTime
 from sqlalchemy.orm import relationship
 
 from tuneful import app
@@ -31,4 +32,17 @@ class File(Base):
     
     id = Column(Integer, primary_key = True)
     filename = Column(String(1024), nullable = False)
-    song_id = Column(Integer, ForeignKey('songs.id'))
\ No newline at end of file
+    song_id = Column(Integer, ForeignKey('songs.id'), index = True)
+
+class Upload(Base):
+    ''' a name handed out for a direct upload which hasn't been finalized '''
+    __tablename__ = 'uploads'
+
+    id = Column(Integer, primary_key = True)
+    # unique, so two clients can never be given the same name
+    filename = Column(String(1024), nullable = False, unique = True)
+    # handed to the client with the name, and needed to finalize the upload
+    token = Column(String(32), nullable = False)
+    # reservations expire along with their presigned upload URL
+    created = Column(DateTime, nullable = False, index = True,
+        default = datetime.datetime.utcnow)
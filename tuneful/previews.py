@@ -0,0 +1,249 @@
+import os
+import os.path
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from tuneful import app
+from .storage import storage
+from .utils import preview_path
+
+# frames read from the original at a time, so memory use doesn't grow with
+# the length of the upload
+BLOCK_FRAMES = 64 * 1024
+
+# sample widths a preview can be written with
+SAMPLE_WIDTHS = (1, 2)
+
+def to_mono(data, channels, width):
+    '''
+    convert a block of WAV frames to samples downmixed to mono, as floats
+    between -1 and 1
+    '''
+    if width == 1:
+        samples = (numpy.frombuffer(data, numpy.uint8).astype(numpy.float32)
+            - 128) / 128
+    elif width == 2:
+        samples = numpy.frombuffer(data, '<i2').astype(numpy.float32) / 2 ** 15
+    elif width == 3:
+        # no 24 bit dtype, so widen each sample to 32 bits by hand
+        raw = numpy.frombuffer(data, numpy.uint8).reshape(-1, 3)
+        padded = numpy.zeros((len(raw), 4), numpy.uint8)
+        padded[:, 1:] = raw
+        samples = padded.view('<i4').ravel().astype(numpy.float32) / 2 ** 31
+    elif width == 4:
+        samples = numpy.frombuffer(data, '<i4').astype(numpy.float32) / 2 ** 31
+    else:
+        raise wave.Error('Unsupported sample width {}'.format(width))
+
+    samples = samples[:len(samples) // channels * channels]
+    return samples.reshape(-1, channels).mean(axis = 1)
+
+class Downsampler(object):
+    """
+    Lowers the sample rate of a stream of sample blocks.  Each block is
+    averaged over a window of neighbouring samples, so high frequencies
+    which can't be represented at the lower rate don't alias into audible
+    noise, then linearly interpolated at the output rate.  The end of each
+    block is carried over so the output is the same however the input is
+    split up.
+    """
+    def __init__(self, rate, target):
+        self.step = rate / float(target) if rate > target else 1.0
+        self.rate = target if rate > target else rate
+        self.window = max(1, int(round(self.step)))
+        # the last window - 1 input samples, for the moving average
+        self.tail = numpy.zeros(self.window - 1, numpy.float32)
+        # the last filtered sample, for interpolating across blocks
+        self.previous = None
+        # the input position of the next filtered sample
+        self.offset = 0
+        # the input position of the next output sample
+        self.position = 0.0
+
+    def process(self, samples):
+        if self.step == 1.0 or not len(samples):
+            return samples
+
+        joined = numpy.concatenate([self.tail, samples])
+        totals = numpy.cumsum(numpy.concatenate([[0], joined]))
+        filtered = (totals[self.window:] - totals[:-self.window]) / self.window
+        if self.window > 1:
+            self.tail = joined[-(self.window - 1):]
+
+        start = self.offset
+        if self.previous is not None:
+            filtered = numpy.concatenate([[self.previous], filtered])
+            start -= 1
+        last = self.offset + len(samples) - 1
+        self.previous = filtered[-1]
+        self.offset += len(samples)
+
+        if last < self.position:
+            return numpy.zeros(0)
+        count = int((last - self.position) // self.step) + 1
+        positions = self.position + self.step * numpy.arange(count)
+        self.position += self.step * count
+        return numpy.interp(positions,
+            numpy.arange(start, start + len(filtered)), filtered)
+
+def quantize(samples, width):
+    samples = numpy.clip(samples, -1, 1)
+    if width == 1:
+        return numpy.round(samples * 127 + 128).astype(numpy.uint8).tobytes()
+    if width == 2:
+        return numpy.round(samples * (2 ** 15 - 1)).astype('<i2').tobytes()
+    raise ValueError('Unsupported preview sample width {}'.format(width))
+
+def transcode(source, destination, rate = 11025, width = 1):
+    '''
+    write a smaller preview of the WAV file `source` to `destination`: mono,
+    at most `rate` frames per second, with `width` bytes per sample
+    '''
+    if width not in SAMPLE_WIDTHS:
+        raise ValueError('Unsupported preview sample width {}'.format(width))
+
+    with wave.open(source, 'rb') as original:
+        channels = original.getnchannels()
+        original_width = original.getsampwidth()
+        downsampler = Downsampler(original.getframerate(), rate)
+        with wave.open(destination, 'wb') as preview:
+            preview.setnchannels(1)
+            preview.setsampwidth(width)
+            preview.setframerate(downsampler.rate)
+            while True:
+                data = original.readframes(BLOCK_FRAMES)
+                if not data:
+                    break
+                samples = to_mono(data, channels, original_width)
+                preview.writeframes(quantize(downsampler.process(samples),
+                    width))
+
+class PreviewCache(object):
+    """
+    A folder of preview files which is kept under a byte budget by deleting
+    the least recently used previews.  A file's modification time records
+    when it was last used.
+    """
+    def __init__(self, root, budget):
+        self.root = root
+        self.budget = budget
+        self.lock = threading.Lock()
+
+    def path(self, file_id):
+        return os.path.join(self.root, '{}.wav'.format(file_id))
+
+    def get(self, file_id):
+        ''' the path of a cached preview, or None if it isn't cached '''
+        path = self.path(file_id)
+        try:
+            os.utime(path, None)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, file_id, write):
+        ''' create a preview by calling `write` with a path to write it to '''
+        os.makedirs(self.root, exist_ok = True)
+        fd, temporary = tempfile.mkstemp(dir = self.root, suffix = '.tmp')
+        os.close(fd)
+        try:
+            write(temporary)
+            os.replace(temporary, self.path(file_id))
+        except Exception:
+            os.remove(temporary)
+            raise
+        self.evict(keep = self.path(file_id))
+
+    def evict(self, keep = None):
+        '''
+        delete the least recently used previews until under budget, sparing
+        the preview at `keep` so that it can be served at least once
+        '''
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.root):
+                if entry.is_file() and entry.name.endswith('.wav'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for mtime, size, path in entries)
+            for mtime, size, path in sorted(entries):
+                if total <= self.budget:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+if app.config.get('PREVIEW_SAMPLE_WIDTH', 1) not in SAMPLE_WIDTHS:
+    raise ValueError('PREVIEW_SAMPLE_WIDTH must be one of {}'.format(
+        ', '.join(str(width) for width in SAMPLE_WIDTHS)))
+
+cache = PreviewCache(preview_path(), app.config.get('PREVIEW_CACHE_BYTES',
+    512 * 1024 * 1024))
+executor = ThreadPoolExecutor(app.config.get('PREVIEW_WORKERS', 2))
+# previews being made or waiting to be made; no more than PREVIEW_QUEUE_SIZE
+# are accepted, so a burst of uploads can't queue up unbounded work
+_jobs = {}
+# when previews which failed to be made may be tried again, by file id
+_failed = {}
+_lock = threading.Lock()
+
+def available(file):
+    ''' whether a preview can be made of a file '''
+    if numpy is None or not file.filename.lower().endswith('.wav'):
+        return False
+    with _lock:
+        return _failed.get(file.id, 0) <= time.monotonic()
+
+def failed(file_id):
+    ''' hold off retrying a failed preview for PREVIEW_RETRY_AFTER seconds '''
+    now = time.monotonic()
+    with _lock:
+        for key, retry in list(_failed.items()):
+            if retry <= now:
+                del _failed[key]
+        # forget the oldest failures rather than growing without limit
+        while len(_failed) >= app.config.get('PREVIEW_FAILURES_KEPT', 1024):
+            del _failed[next(iter(_failed))]
+        _failed[file_id] = now + app.config.get('PREVIEW_RETRY_AFTER', 300)
+
+def render(file_id, filename):
+    def write(path):
+        with storage.open(filename) as source:
+            transcode(source, path, app.config.get('PREVIEW_RATE', 11025),
+                app.config.get('PREVIEW_SAMPLE_WIDTH', 1))
+    try:
+        cache.put(file_id, write)
+    except Exception:
+        # nothing waits on the job's future, so log the error here
+        app.logger.exception('Could not create a preview of file {}'.format(
+            file_id))
+        failed(file_id)
+        raise
+    finally:
+        with _lock:
+            _jobs.pop(file_id, None)
+
+def generate(file):
+    '''
+    start making a preview of a file in the background, returning a future
+    for it; a preview which is already being made is not started again.
+    Returns None if the queue is full.
+    '''
+    with _lock:
+        if file.id not in _jobs:
+            if len(_jobs) >= app.config.get('PREVIEW_QUEUE_SIZE', 16):
+                return None
+            _jobs[file.id] = executor.submit(render, file.id, file.filename)
+        return _jobs[file.id]
@@ -0,0 +1,122 @@
+from flask import url_for
+
+from . import models
+
+# The columns a song list can be built from, selected by label
+columns = {
+    'song_id': models.Song.id,
+    'file_id': models.File.id,
+    'filename': models.File.filename,
+}
+
+# The fields a song can be serialized with, in output order, and the column
+# each one is read from
+song_fields = [
+    ('id', 'song_id'),
+    ('file.id', 'file_id'),
+    ('file.name', 'filename'),
+    ('file.path', 'filename'),
+]
+
+embeds = ['file', 'id']
+
+formats = ['objects', 'columnar']
+
+def select_song_fields(fields = None, embed = 'file'):
+    '''
+    work out which song fields to return from the `fields` and `embed` query
+    parameters, raising a ValueError if either is invalid; `fields` is a
+    comma separated list of names such as `id,file.name`, where `file` on its
+    own selects every file field; empty names are skipped
+    '''
+    if embed not in embeds:
+        raise ValueError('Unknown embed {}, must be one of {}'.format(embed,
+            ', '.join(embeds)))
+
+    known = [field for field, column in song_fields]
+    if fields is None:
+        requested = set(known)
+    else:
+        requested = set()
+        for name in fields.split(','):
+            name = name.strip()
+            if not name:
+                continue
+            if name == 'file':
+                requested.update(field for field in known
+                    if field.startswith('file.'))
+            elif name in known:
+                requested.add(name)
+            else:
+                raise ValueError('Unknown field {}'.format(name))
+        if not requested:
+            raise ValueError('No fields were requested')
+
+    # a bare file id is all that can be embedded in place of the file
+    if embed == 'id' and any(field.startswith('file.') for field in requested):
+        requested = set(field for field in requested
+            if not field.startswith('file.'))
+        requested.add('file.id')
+
+    return [field for field in known if field in requested]
+
+def check_format(format):
+    ''' raise a ValueError if `format` isn't a song list format '''
+    if format not in formats:
+        raise ValueError('Unknown format {}, must be one of {}'.format(format,
+            ', '.join(formats)))
+
+def query_songs(session, fields):
+    ''' query only the columns needed for the selected fields '''
+    labels = []
+    for field, label in song_fields:
+        if field in fields and label not in labels:
+            labels.append(label)
+
+    includes_file = any(field.startswith('file.') for field in fields)
+    # the file id tells songs without a file apart from empty file fields
+    if includes_file and 'file_id' not in labels:
+        labels.append('file_id')
+
+    query = session.query(*[columns[label].label(label) for label in labels])
+    if includes_file:
+        query = query.select_from(models.Song).outerjoin(models.File,
+            models.File.song_id == models.Song.id)
+    return query.order_by(models.Song.id)
+
+def field_value(row, field):
+    value = getattr(row, dict(song_fields)[field])
+    if field == 'file.path' and value is not None:
+        return url_for('uploaded_file', filename = value)
+    return value
+
+def field_name(field, embed):
+    ''' the key a field is written under in the columnar format '''
+    if embed == 'id' and field == 'file.id':
+        return 'file'
+    return field
+
+def song_dictionary(row, fields, embed = 'file'):
+    song = {}
+    for field in fields:
+        if field == 'id':
+            song['id'] = row.song_id
+        elif embed == 'id':
+            song['file'] = row.file_id
+        elif row.file_id is None:
+            song['file'] = None
+        else:
+            song.setdefault('file', {})[field[len('file.'):]] = field_value(
+                row, field)
+    return song
+
+def songs_columnar(rows, fields, embed = 'file'):
+    '''
+    serialize songs as parallel arrays, one per field, rather than as a list
+    of objects; much smaller for long lists as the keys are not repeated
+    '''
+    data = dict((field_name(field, embed), []) for field in fields)
+    for row in rows:
+        for field in fields:
+            data[field_name(field, embed)].append(field_value(row, field))
+    return data
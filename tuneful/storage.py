@@ -0,0 +1,232 @@
+import os
+import os.path
+import hashlib
+import tempfile
+import time
+
+from flask import abort, redirect, send_from_directory
+
+from tuneful import app
+from .utils import upload_path
+
+class Storage(object):
+    """
+    Base class for upload storage backends.  Files are keyed by a hash prefix
+    of their filename (e.g. `3f/a2/song.wav`) so they spread evenly across
+    directories or object store partitions.
+    """
+    # whether the backend has an `upload_url` clients can upload straight to
+    direct_uploads = False
+
+    def __init__(self, depth = 2, width = 2):
+        self.depth = depth
+        self.width = width
+
+    def key(self, filename):
+        ''' the path of a file relative to the storage root '''
+        digest = hashlib.md5(filename.encode('utf-8')).hexdigest()
+        shards = [digest[i * self.width:(i + 1) * self.width]
+            for i in range(self.depth)]
+        return '/'.join(shards + [filename])
+
+    def candidates(self, filename):
+        ''' yield the filename, then numbered variants of it '''
+        yield filename
+        name, ext = os.path.splitext(filename)
+        count = 1
+        while True:
+            yield '{}-{}{}'.format(name, count, ext)
+            count += 1
+
+class LocalStorage(Storage):
+    """
+    Stores uploads on the local disk, sharded into nested directories under
+    the upload folder.  Files left in the flat upload folder by older
+    versions of the app stay readable until `migrate` has moved them into
+    their shard.
+    """
+    def __init__(self, root, depth = 2, width = 2):
+        super(LocalStorage, self).__init__(depth, width)
+        self.root = root
+
+    def path(self, filename):
+        ''' the sharded location of a file '''
+        return os.path.join(self.root, *self.key(filename).split('/'))
+
+    def legacy_path(self, filename):
+        ''' the location of a file in the old flat layout '''
+        return os.path.join(self.root, filename)
+
+    def locate(self, filename):
+        ''' find a file in either layout, returning None if it is missing '''
+        # the sharded path is checked again last in case a migration moved
+        # the file between the first two checks
+        for path in (self.path(filename), self.legacy_path(filename),
+            self.path(filename)):
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def exists(self, filename):
+        return self.locate(filename) is not None
+
+    def save(self, file, filename):
+        '''
+        save an uploaded file, returning the name it was stored under; if the
+        name is already taken a numbered variant is used rather than
+        overwriting the existing file
+        '''
+        if not filename:
+            raise ValueError('Cannot save a file without a name')
+        for candidate in self.candidates(filename):
+            if os.path.isfile(self.legacy_path(candidate)):
+                continue
+            path = self.path(candidate)
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            try:
+                # O_EXCL reserves the name so concurrent uploads can't clash
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                continue
+            with os.fdopen(fd, 'wb') as destination:
+                file.save(destination)
+            return candidate
+
+    def open(self, filename):
+        path = self.locate(filename)
+        if path is None:
+            raise IOError('Could not find file {}'.format(filename))
+        return open(path, 'rb')
+
+    def send(self, filename):
+        path = self.locate(filename)
+        if path is None:
+            abort(404)
+        return send_from_directory(os.path.dirname(path),
+            os.path.basename(path))
+
+    def legacy_files(self):
+        ''' the names of files still stored in the flat layout '''
+        if not os.path.isdir(self.root):
+            return
+        for entry in os.scandir(self.root):
+            if entry.is_file():
+                yield entry.name
+
+    def migrate(self, batch_size = 100, delay = 0.5, log = None):
+        '''
+        move files from the flat layout into their shards, pausing for
+        `delay` seconds between batches of `batch_size` files so the disk
+        stays available to the running app; returns the number moved
+        '''
+        moved = 0
+        batch = 0
+        for filename in self.legacy_files():
+            source = self.legacy_path(filename)
+            destination = self.path(filename)
+            os.makedirs(os.path.dirname(destination), exist_ok = True)
+            # link then unlink, so the file is readable at every moment and
+            # an upload which already claimed the sharded name is never lost
+            try:
+                os.link(source, destination)
+            except FileNotFoundError:
+                continue
+            except FileExistsError:
+                if log:
+                    log('Skipping {}, already exists in shard'.format(filename))
+                continue
+            os.remove(source)
+            moved += 1
+            batch += 1
+            if batch >= batch_size:
+                if log:
+                    log('Moved {} files'.format(moved))
+                batch = 0
+                time.sleep(delay)
+        return moved
+
+class S3Storage(Storage):
+    """
+    Stores uploads in an S3-compatible object store.  Clients upload and
+    download directly through presigned URLs, so the file data never passes
+    through the app's workers.
+
+    A presigned upload URL can't be revoked, so until it expires the client
+    it was issued to can replace the object, even after the upload has been
+    finalized.  `upload_expiry` is kept short to narrow that window.
+    """
+    direct_uploads = True
+
+    def __init__(self, bucket, endpoint_url = None, expiry = 3600,
+        upload_expiry = 900, client = None, depth = 2, width = 2):
+        super(S3Storage, self).__init__(depth, width)
+        if client is None:
+            import boto3
+            client = boto3.client('s3', endpoint_url = endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.expiry = expiry
+        self.upload_expiry = upload_expiry
+
+    def exists(self, filename):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket = self.bucket,
+                Key = self.key(filename))
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
+        return True
+
+    def upload_url(self, filename):
+        ''' a presigned URL the client can PUT the file data to '''
+        return self.client.generate_presigned_url('put_object',
+            Params = {'Bucket': self.bucket, 'Key': self.key(filename)},
+            ExpiresIn = self.upload_expiry)
+
+    def download_url(self, filename):
+        return self.client.generate_presigned_url('get_object',
+            Params = {'Bucket': self.bucket, 'Key': self.key(filename)},
+            ExpiresIn = self.expiry)
+
+    def save(self, file, filename):
+        '''
+        save an uploaded file under exactly the name given, which the caller
+        must have reserved so no other upload can be using it
+        '''
+        self.client.upload_fileobj(file.stream, self.bucket,
+            self.key(filename))
+        return filename
+
+    def open(self, filename):
+        '''
+        download a file to a seekable temporary file, which only holds the
+        first few megabytes in memory and spills the rest to disk
+        '''
+        from botocore.exceptions import ClientError
+        spool = tempfile.SpooledTemporaryFile(8 * 1024 * 1024)
+        try:
+            self.client.download_fileobj(self.bucket, self.key(filename),
+                spool)
+        except ClientError:
+            spool.close()
+            raise IOError('Could not find file {}'.format(filename))
+        spool.seek(0)
+        return spool
+
+    def send(self, filename):
+        if not self.exists(filename):
+            abort(404)
+        return redirect(self.download_url(filename))
+
+def create_storage(config):
+    ''' build the storage backend selected by the app config '''
+    if config.get('STORAGE_BACKEND', 'local') == 's3':
+        return S3Storage(config['S3_BUCKET'],
+            endpoint_url = config.get('S3_ENDPOINT_URL'),
+            expiry = config.get('S3_URL_EXPIRY', 3600),
+            upload_expiry = config.get('S3_UPLOAD_URL_EXPIRY', 900))
+    return LocalStorage(upload_path())
+
+storage = create_storage(app.config)
@@ -4,3 +4,6 @@ from tuneful import app
 
 def upload_path(filename=""):
     return os.path.join(app.root_path, app.config["UPLOAD_FOLDER"], filename)
+
+def preview_path(filename=""):
+    return os.path.join(app.root_path, app.config["PREVIEW_FOLDER"], filename)